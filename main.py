@@ -1,33 +1,53 @@
-from fastapi import FastAPI, HTTPException, Depends
-from pydantic import BaseModel, EmailStr, Field
-from typing import List, Literal
+from fastapi import FastAPI, HTTPException, Request, Response
+from pydantic import BaseModel, Field, field_validator
+from typing import Dict, List, Literal
 import cohere
 import os
 from pathlib import Path
-from datetime import datetime
+import time
 from dotenv import load_dotenv
-import csv
-from io import StringIO
 from fastapi.responses import StreamingResponse
-from contextlib import asynccontextmanager
+from contextlib import aclosing, asynccontextmanager
 import random
+import asyncio
+import hashlib
+import re
+import orjson
+import httpx
+from cohere.errors import TooManyRequestsError
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from cachetools import TTLCache
 
 # Load environment variables
 env_path = Path('.') / 'variables.env'
 load_dotenv(dotenv_path=env_path)
 
+# Process start, used for uptime reporting
+START_MONO = time.monotonic()
+
+# Basic shape check for contact emails; cheaper than full EmailStr
+# validation for bulk contact lists
+EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+
 # Input Models with new fields for A/B testing
 class Contact(BaseModel):
     name: str = Field(..., min_length=1, max_length=100)
-    email: EmailStr
+    email: str = Field(..., max_length=254)
     job_title: str = Field(..., min_length=1, max_length=100)
     group: Literal["A", "B"] = "A"  # Default group for A/B testing
 
+    @field_validator("email")
+    @classmethod
+    def validate_email(cls, value: str) -> str:
+        if not EMAIL_RE.fullmatch(value):
+            raise ValueError("value is not a valid email address")
+        return value
+
 class Account(BaseModel):
     account_name: str = Field(..., min_length=1, max_length=200)
     industry: str = Field(..., min_length=1, max_length=100)
-    pain_points: List[str] = Field(..., min_items=1, max_items=5)
-    contacts: List[Contact] = Field(..., min_items=1)
+    pain_points: List[str] = Field(..., min_length=1, max_length=5)
+    contacts: List[Contact] = Field(..., min_length=1)
     campaign_objective: Literal["awareness", "nurturing", "upselling"]
 
     # New fields for interest, tone, and language
@@ -48,19 +68,40 @@ class Campaign(BaseModel):
     emails: List[Email]
 
 class CampaignRequest(BaseModel):
-    accounts: List[Account] = Field(..., min_items=1, max_items=10)
+    accounts: List[Account] = Field(..., min_length=1, max_length=10)
     number_of_emails: int = Field(..., gt=0, le=10)
 
 class CampaignResponse(BaseModel):
     campaigns: List[Campaign]
 
+# Maximum number of Cohere calls in flight across the whole process
+COHERE_CONCURRENCY = int(os.getenv("COHERE_CONCURRENCY", "8"))
+COHERE_SEM = asyncio.Semaphore(COHERE_CONCURRENCY)
+
 # Application lifecycle management
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Validate environment on startup
-    if not os.getenv("COHERE_API_KEY"):
+    api_key = os.getenv("COHERE_API_KEY")
+    if not api_key:
         raise ValueError("COHERE_API_KEY environment variable is not set")
-    yield
+    app.state.api_key = api_key
+    # One keep-alive pool shared by every request instead of a fresh
+    # session (and TLS handshake) per call
+    # Explicit timeout: with a custom httpx client the SDK no longer applies
+    # its own 300s default and httpx would fall back to 5s
+    app.state.http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(300),
+        limits=httpx.Limits(
+            max_connections=COHERE_CONCURRENCY,
+            max_keepalive_connections=COHERE_CONCURRENCY
+        )
+    )
+    app.state.cohere = cohere.AsyncClient(api_key, httpx_client=app.state.http_client)
+    try:
+        yield
+    finally:
+        await app.state.http_client.aclose()
 
 app = FastAPI(
     title="Email Drip Campaign API with A/B Testing",
@@ -69,96 +110,284 @@ app = FastAPI(
     lifespan=lifespan
 )
 
-# Dependency for Cohere client
-def get_cohere_client():
-    api_key = os.getenv("COHERE_API_KEY")
-    if not api_key:
-        raise HTTPException(status_code=500, detail="Cohere API key not found")
-    return cohere.Client(api_key)
-
-def generate_email_content(client: cohere.Client, account: Account, email_number: int, total_emails: int) -> List[EmailVariant]:
-    """Generate multiple email variants for A/B testing."""
-    variants = []
-    for tone in ["formal", "casual"]:  # Example tones for A/B testing
-        prompt = f"""
-        Create a personalized email for the following business account:
-        Company: {account.account_name}
-        Industry: {account.industry}
-        Pain Points: {', '.join(account.pain_points)}
-        Campaign Stage: Email {email_number} of {total_emails}
-        Campaign Objective: {account.campaign_objective}
-        Recipient Job Title: {account.contacts[0].job_title}
-
-        Interest: {account.interest}
-        Tone: {tone}
-        Language: {account.language}
-
-        Generate a JSON response with:
-        1. An engaging and catchy subject line
-        2. Personalized email body
-        3. Clear call-to-action
-
-        Format the response as valid JSON with keys: "subject", "body", "call_to_action"
-        """
-        try:
-            response = client.generate(
-                model="command-xlarge-nightly",
-                prompt=prompt,
-                max_tokens=300,
-                temperature=0.7,
-            )
-            email_data = eval(response.generations[0].text.strip())
-            variants.append(
-                EmailVariant(
-                    subject=email_data["subject"],
-                    body=email_data["body"],
-                    call_to_action=email_data["call_to_action"]
+# Tones used for the A/B variants of every email
+TONES = ("formal", "casual")
+
+# Completions keyed by prompt hash; identical prompts skip the Cohere call
+GENERATION_CACHE = TTLCache(maxsize=10_000, ttl=3600)
+
+# Pending generations by prompt hash, shared across batches and requests
+IN_FLIGHT: Dict[str, asyncio.Task] = {}
+
+def prompt_cache_key(prompt: str) -> str:
+    return hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+
+# Finished campaign responses keyed by request hash, so the JSON and CSV
+# endpoints don't generate the same request twice
+RESULTS_CACHE = TTLCache(maxsize=128, ttl=600)
+
+def request_cache_key(request: CampaignRequest) -> str:
+    payload = orjson.dumps(request.model_dump(), option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+# Stands in for the account name so accounts with the same profile share
+# one prompt; replaced with the real name after generation
+COMPANY_PLACEHOLDER = "[COMPANY]"
+
+# Invariant instructions kept at the start of every prompt so the provider
+# can reuse the cached prefix across calls
+SYSTEM_PREFIX = f"""Create a personalized email for the business account described below.
+
+Generate a JSON response with:
+1. An engaging and catchy subject line
+2. Personalized email body
+3. Clear call-to-action
+
+Format the response as valid JSON with keys: "subject", "body", "call_to_action"
+Refer to the company only as {COMPANY_PLACEHOLDER}; the real name is filled in afterwards.
+
+"""
+
+# Per-variant fields appended after SYSTEM_PREFIX
+PROMPT_TMPL = """Company: {company}
+Industry: {industry}
+Pain Points: {pain_points}
+Campaign Stage: Email {email_number} of {total_emails}
+Campaign Objective: {campaign_objective}
+Recipient Job Title: {job_title}
+Interest: {interest}
+Tone: {tone}
+Language: {language}
+"""
+
+def build_campaign_prompts(account: Account, number_of_emails: int) -> List[str]:
+    """Build all prompts for an account, ordered by email then tone."""
+    # Account-level fields are resolved once and reused for every variant
+    params = {
+        "company": COMPANY_PLACEHOLDER,
+        "industry": account.industry,
+        "pain_points": ", ".join(account.pain_points),
+        "total_emails": number_of_emails,
+        "campaign_objective": account.campaign_objective,
+        "job_title": account.contacts[0].job_title,
+        "interest": account.interest,
+        "language": account.language,
+    }
+    prompts = []
+    for i in range(number_of_emails):
+        params["email_number"] = i + 1
+        for tone in TONES:
+            params["tone"] = tone
+            prompts.append(SYSTEM_PREFIX + PROMPT_TMPL.format_map(params))
+    return prompts
+
+async def generate_text(client: cohere.AsyncClient, prompt: str) -> str:
+    """Generate a single completion, retrying when rate limited."""
+    async for attempt in AsyncRetrying(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential_jitter(initial=1, max=10),
+        retry=retry_if_exception_type(TooManyRequestsError),
+        reraise=True
+    ):
+        with attempt:
+            # Hold a slot only while the call is in flight, not during backoff
+            async with COHERE_SEM:
+                text = ""
+                stream = client.generate_stream(
+                    model="command-xlarge-nightly",
+                    prompt=prompt,
+                    max_tokens=300,
+                    temperature=0.7,
                 )
-            )
-        except Exception as e:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Error generating email variant: {str(e)}"
-            )
-    return variants
+                # Closed explicitly so stopping early returns the connection
+                # to the pool before the slot is released
+                async with aclosing(stream):
+                    async for event in stream:
+                        if event.event_type == "stream-error":
+                            raise RuntimeError(f"Cohere stream failed: {event.err}")
+                        if event.event_type != "text-generation":
+                            continue
+                        text += event.text
+                        # Stop as soon as a complete JSON object has arrived
+                        # rather than waiting for any trailing tokens
+                        if "}" in event.text and is_complete_json(text):
+                            break
+                    else:
+                        raise ValueError("Generation ended without a complete JSON object")
+    return text
 
-def generate_campaign(client: cohere.Client, account: Account, number_of_emails: int) -> Campaign:
-    """Generate a complete email campaign with A/B testing variants."""
+async def generate_and_cache(client: cohere.AsyncClient, key: str, prompt: str) -> str:
+    """Generate a completion and cache it once it is known to be usable."""
+    text = await generate_text(client, prompt)
+    # Only usable completions are cached so a bad one can be regenerated
+    validate_completion(text)
+    GENERATION_CACHE[key] = text
+    return text
+
+def finish_in_flight(key: str, task: asyncio.Task) -> None:
+    """Forget a finished generation and consume its outcome."""
+    IN_FLIGHT.pop(key, None)
+    # Retrieve the exception so it isn't reported as never retrieved when
+    # every waiter was cancelled before the call finished
+    if not task.cancelled():
+        task.exception()
+
+async def generate_cached(client: cohere.AsyncClient, prompt: str) -> str:
+    """Generate a completion once per distinct prompt, sharing in-flight calls."""
+    key = prompt_cache_key(prompt)
+    text = GENERATION_CACHE.get(key)
+    if text is not None:
+        return text
+
+    # Duplicate prompts issued while a call is pending await that same call
+    task = IN_FLIGHT.get(key)
+    if task is None:
+        # The task caches its own result, so it still counts if every
+        # waiter goes away before it finishes
+        task = asyncio.create_task(generate_and_cache(client, key, prompt))
+        IN_FLIGHT[key] = task
+        task.add_done_callback(lambda done: finish_in_flight(key, done))
+
+    # Shielded so one cancelled waiter doesn't cancel the call for the others
+    return await asyncio.shield(task)
+
+async def generate_batch(client: cohere.AsyncClient, prompts: List[str]) -> List[str]:
+    """Generate completions for a list of prompts, preserving their order."""
+    try:
+        # COHERE_SEM bounds how many of these actually run at once
+        return list(await asyncio.gather(*[
+            generate_cached(client, prompt) for prompt in prompts
+        ]))
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Error generating email variant: {str(e)}"
+        )
+
+# Outermost JSON object in a completion, ignoring any preamble or trailer
+JSON_OBJECT_RE = re.compile(r"\{.*\}", re.S)
+
+def parse_json(text: str) -> dict:
+    """Extract and parse the JSON object from a model completion."""
+    match = JSON_OBJECT_RE.search(text)
+    if not match:
+        raise ValueError("No JSON object found in generated text")
+    return orjson.loads(match.group(0))
+
+# Keys every generated email variant must provide
+VARIANT_KEYS = ("subject", "body", "call_to_action")
+
+def validate_completion(text: str) -> dict:
+    """Parse a completion and check it has every email variant field."""
+    email_data = parse_json(text)
+    if not isinstance(email_data, dict):
+        raise ValueError("Generated JSON is not an object")
+    for field in VARIANT_KEYS:
+        if not isinstance(email_data.get(field), str):
+            raise ValueError(f"Generated JSON is missing string field '{field}'")
+    return email_data
+
+def is_complete_json(text: str) -> bool:
+    """Check whether streamed text already contains a complete email variant."""
+    try:
+        validate_completion(text)
+    except ValueError:
+        return False
+    return True
+
+# Campaigns are handled as plain dicts shaped like the response models;
+# those models only describe the API schema
+
+def parse_email_variant(text: str, account_name: str) -> dict:
+    """Parse a generated completion into an EmailVariant-shaped dict."""
+    email_data = validate_completion(text)
+    return {
+        "subject": email_data["subject"].replace(COMPANY_PLACEHOLDER, account_name),
+        "body": email_data["body"].replace(COMPANY_PLACEHOLDER, account_name),
+        "call_to_action": email_data["call_to_action"].replace(COMPANY_PLACEHOLDER, account_name)
+    }
+
+def assemble_campaign(account: Account, number_of_emails: int, texts: List[str]) -> dict:
+    """Build a Campaign-shaped dict from the completions of build_campaign_prompts."""
     try:
         emails = []
-        for contact in account.contacts:
-            # Randomly assign groups for A/B testing
-            contact.group = random.choice(["A", "B"])
-        
         for i in range(number_of_emails):
-            email_variants = generate_email_content(client, account, i + 1, number_of_emails)
-            emails.append(Email(variants=email_variants))
+            offset = i * len(TONES)
+            emails.append({"variants": [
+                parse_email_variant(text, account.account_name)
+                for text in texts[offset:offset + len(TONES)]
+            ]})
         
-        return Campaign(account_name=account.account_name, emails=emails)
+        return {"account_name": account.account_name, "emails": emails}
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Error generating campaign for {account.account_name}: {str(e)}"
         )
 
+async def generate_campaign(client: cohere.AsyncClient, account: Account, number_of_emails: int) -> dict:
+    """Generate a complete email campaign with A/B testing variants."""
+    texts = await generate_batch(client, build_campaign_prompts(account, number_of_emails))
+    return assemble_campaign(account, number_of_emails, texts)
+
+# Doubles embedded quotes inside a quoted CSV field
+CSV_QUOTE_TRANS = str.maketrans({'"': '""'})
+
+def csv_row(values) -> bytes:
+    """Encode one CSV row with every field quoted."""
+    return ('"' + '","'.join(str(value).translate(CSV_QUOTE_TRANS) for value in values) + '"\r\n').encode()
+
+CSV_HEADER = csv_row(('Account Name', 'Email Number', 'Variant', 'Subject', 'Body', 'Call to Action'))
+
+def assign_ab_groups(account: Account) -> None:
+    """Randomly assign the account's contacts to A/B testing groups."""
+    # Draw every assignment in one call rather than one per contact
+    groups = random.choices(("A", "B"), k=len(account.contacts))
+    for contact, group in zip(account.contacts, groups):
+        contact.group = group
+
 @app.post(
     "/generate-campaigns/",
     response_model=CampaignResponse,
     summary="Generate email campaigns with A/B testing",
     response_description="Generated email campaigns for the provided accounts"
 )
-def generate_campaigns(
-    request: CampaignRequest,
-    client: cohere.Client = Depends(get_cohere_client)
-) -> CampaignResponse:
+async def generate_campaigns(
+    request: Request,
+    body: CampaignRequest,
+    response: Response
+) -> dict:
     """Generate personalized email campaigns for multiple accounts."""
+    client = request.app.state.cohere
     try:
-        campaigns = []
-        for account in request.accounts:
-            campaign = generate_campaign(client, account, request.number_of_emails)
-            campaigns.append(campaign)
+        # Hash before A/B assignment mutates the contacts
+        cache_key = request_cache_key(body)
+        response.headers["X-Cache-Key"] = cache_key
+        cached = RESULTS_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
+
+        prompts = []
+        for account in body.accounts:
+            assign_ab_groups(account)
+            prompts.extend(build_campaign_prompts(account, body.number_of_emails))
+
+        # One batch for every variant of every account in the request
+        texts = await generate_batch(client, prompts)
+
+        per_account = body.number_of_emails * len(TONES)
+        campaigns = [
+            assemble_campaign(
+                account,
+                body.number_of_emails,
+                texts[idx * per_account:(idx + 1) * per_account]
+            )
+            for idx, account in enumerate(body.accounts)
+        ]
         
-        return CampaignResponse(campaigns=campaigns)
+        result = {"campaigns": campaigns}
+        RESULTS_CACHE[cache_key] = result
+        return result
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -170,40 +399,61 @@ def generate_campaigns(
     summary="Export campaigns as CSV",
     response_description="CSV file containing all generated campaigns"
 )
-def export_campaigns_csv(
-    request: CampaignRequest,
-    client: cohere.Client = Depends(get_cohere_client)
+async def export_campaigns_csv(
+    request: Request,
+    body: CampaignRequest
 ):
-    """Export campaigns in CSV format for email automation tools."""
+    """Export campaigns in CSV format for email automation tools.
+
+    Reuses the result of a previous /generate-campaigns/ call for the same
+    request body.
+    """
+    client = request.app.state.cohere
     try:
-        # Generate the campaigns first
-        campaigns_response = generate_campaigns(request, client)
-        
-        # Create CSV in memory
-        output = StringIO()
-        writer = csv.writer(output)
-        
-        # Write headers
-        writer.writerow(['Account Name', 'Email Number', 'Variant', 'Subject', 'Body', 'Call to Action'])
-        
-        # Write data
-        for campaign in campaigns_response.campaigns:
-            for i, email in enumerate(campaign.emails, 1):
-                for variant_idx, variant in enumerate(email.variants, 1):
-                    writer.writerow([
-                        campaign.account_name,
-                        f"Email {i}",
-                        f"Variant {variant_idx}",
-                        variant.subject,
-                        variant.body,
-                        variant.call_to_action
-                    ])
-        
-        # Prepare the response
-        output.seek(0)
-        filename = f"campaigns_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        request_key = request_cache_key(body)
+        cached = RESULTS_CACHE.get(request_key)
+
+        if cached is not None:
+            campaigns = cached["campaigns"]
+        else:
+            # Generate each account's campaign concurrently
+            tasks = []
+            for account in body.accounts:
+                assign_ab_groups(account)
+                tasks.append(asyncio.create_task(
+                    generate_campaign(client, account, body.number_of_emails)
+                ))
+
+            # Every campaign must succeed before the response starts, so a
+            # failure is a 500 rather than a truncated CSV
+            try:
+                campaigns = await asyncio.gather(*tasks)
+            except Exception:
+                for task in tasks:
+                    task.cancel()
+                raise
+            RESULTS_CACHE[request_key] = {"campaigns": campaigns}
+
+        async def row_iter():
+            # Rows are encoded lazily, one at a time, as the body is sent
+            yield CSV_HEADER
+
+            for campaign in campaigns:
+                account_name = campaign["account_name"]
+                for i, email in enumerate(campaign["emails"], 1):
+                    for variant_idx, variant in enumerate(email["variants"], 1):
+                        yield csv_row((
+                            account_name,
+                            f"Email {i}",
+                            f"Variant {variant_idx}",
+                            variant["subject"],
+                            variant["body"],
+                            variant["call_to_action"]
+                        ))
+
+        filename = f"campaigns_{time.strftime('%Y%m%d_%H%M%S')}.csv"
         return StreamingResponse(
-            iter([output.getvalue()]),
+            row_iter(),
             media_type="text/csv",
             headers={
                 "Content-Disposition": f"attachment; filename={filename}",
@@ -225,7 +475,7 @@ def health_check():
     """Health check endpoint to verify API status."""
     return {
         "status": "healthy",
-        "timestamp": datetime.now().isoformat(),
+        "uptime_seconds": time.monotonic() - START_MONO,
         "version": "1.0.0",
         "cohere_api_configured": True
     }